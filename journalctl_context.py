@@ -3,13 +3,29 @@
 from collections import deque
 from datetime import datetime
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Dict, List, Optional
 import json
 import argparse
 import sys
 import os
 import subprocess
 import re
+import time
+
+
+def timed(func, stage_times: Dict[str, float], stage: str):
+    """wrap func so the time spent in it is added to stage_times[stage]"""
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_times[stage] = (
+                stage_times.get(stage, 0.0) + time.perf_counter() - start
+            )
+
+    return wrapper
 
 
 @dataclass(slots=True)
@@ -21,11 +37,16 @@ class LogMessage:
         return self.ts.isoformat(timespec="milliseconds") + " " + self.msg
 
     @classmethod
-    def journal_reader(cls, journalctl_args: List[str] = []):
+    def journal_reader(
+        cls,
+        journalctl_args: List[str] = [],
+        journalctl: str = "journalctl",
+        stage_times: Optional[Dict[str, float]] = None,
+    ):
         # delegate to journalctl CLI, because it's better than python systemd
         # library at handling corrupt journal files gracefully
         child = subprocess.Popen(
-            ["journalctl"]
+            [journalctl]
             + journalctl_args
             + ["-q", "-o", "short-iso-precise"],
             text=True,
@@ -38,9 +59,14 @@ class LogMessage:
             linebuf.clear()
             return cls(datetime.fromisoformat(timestamp), message)
 
+        lines = iter(child.stdout)
+        if stage_times is not None:
+            # for benchmarking, see journalctl_context_bench.py
+            lines = iter(timed(lines.__next__, stage_times, "read"), None)
+            produce = timed(produce, stage_times, "parse")
         # put the 1st line in the buffer and loop starting at the 2nd
-        linebuf: List[str] = [next(iter(child.stdout))]
-        for line in child.stdout:
+        linebuf: List[str] = [next(lines)]
+        for line in lines:
             if line[0] != " ":  # not a continuation of the last message
                 yield produce(linebuf)
             linebuf.append(line)
@@ -54,14 +80,27 @@ def journalctl_with_context(
     seconds_after: float,
     extra_args: List[str],
     hilight_match: bool = False,
+    journalctl: str = "journalctl",
+    stage_times: Optional[Dict[str, float]] = None,
 ):
+    """
+    If stage_times is given, the time spent reading, parsing, matching and
+    printing is added to it under those names.
+    """
+    search, sub, emit = re.search, re.sub, print
+    if stage_times is not None:
+        search = timed(search, stage_times, "match")
+        sub = timed(sub, stage_times, "match")
+        emit = timed(emit, stage_times, "print")
     printing: bool = False
     last_seen: Optional[datetime] = None
     msg_buf = deque()
-    for logmsg in LogMessage.journal_reader(extra_args):
-        match = re.search(search_pattern, logmsg.msg)
+    for logmsg in LogMessage.journal_reader(
+        extra_args, journalctl, stage_times
+    ):
+        match = search(search_pattern, logmsg.msg)
         if hilight_match and match:
-            logmsg.msg = re.sub(
+            logmsg.msg = sub(
                 f"({search_pattern})", "\x1b[1m\x1b[31m\\1\x1b[0m", logmsg.msg
             )
         # sliding window of messages
@@ -75,15 +114,15 @@ def journalctl_with_context(
                 printing = True
                 last_seen = logmsg.ts
                 # print the before context and the matching message
-                print("\n".join(str(m) for m in msg_buf))
+                emit("\n".join(str(m) for m in msg_buf))
                 msg_buf.clear()
         else:
             if match:
                 last_seen = logmsg.ts
             if (logmsg.ts - last_seen).total_seconds() <= seconds_after:
-                print(logmsg)
+                emit(logmsg)
             else:
-                print("--")  # to separate matches, same as grep -C
+                emit("--")  # to separate matches, same as grep -C
                 printing = False
 
 
@@ -97,6 +136,12 @@ if __name__ == "__main__":
     ap.add_argument(
         "--color", choices=["never", "always", "auto"], default="auto"
     )
+    ap.add_argument(
+        "--journalctl",
+        metavar="EXECUTABLE",
+        default="journalctl",
+        help="journalctl executable to read from (default: from PATH)",
+    )
     ap.add_argument("pattern", help="python regex search pattern")
     args, extra_args = ap.parse_known_args()
     # precedence logic
@@ -115,5 +160,10 @@ if __name__ == "__main__":
             color = False if "NO_COLOR" in os.environ else sys.stdout.isatty()
     # do it
     journalctl_with_context(
-        args.pattern, before, after, extra_args, hilight_match=color
+        args.pattern,
+        before,
+        after,
+        extra_args,
+        hilight_match=color,
+        journalctl=args.journalctl,
     )
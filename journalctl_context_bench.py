@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark journalctl_context.py without needing a big real journal.
+
+    journalctl_context_bench.py run [options]
+        Render a synthetic journal, put a fake journalctl that replays it on
+        PATH, and measure journalctl_with_context() for several -B/-A window
+        settings: messages/sec, time per stage and peak python memory.
+
+    journalctl_context_bench.py fake [options] [journalctl args...]
+        Be the fake journalctl: write a synthetic journal to stdout. Honours
+        "-o short-iso-precise" (the default) and "-o json"; every other
+        journalctl argument is accepted and ignored.
+
+messages/sec and the total come from journalctl_with_context() itself,
+writing to /dev/null. The stage times come from a separate pass with its
+stage_times timers on:
+
+    read    pulling lines from the child's stdout
+    parse   multi-line joining and fromisoformat, in journal_reader()
+    match   re.search() on every message
+    print   print() to /dev/null
+    window  the rest: the sliding window and the printing state machine
+
+The timers themselves cost a little per message, which ends up in the
+stages, so they add up to somewhat more than the total.
+"""
+
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from journalctl_context import LogMessage, journalctl_with_context
+
+NEEDLE = "NEEDLE"
+FORMATS = ["short-iso-precise", "json"]
+WORDS = (
+    "started stopped reloading failed connection accepted closed from port "
+    "user session opened removed device link is up down timeout retrying "
+    "cache refreshed metadata unit entered state dead running"
+).split()
+IDENTS = [
+    ("systemd", 1),
+    ("kernel", None),
+    ("sshd", 1234),
+    ("NetworkManager", 811),
+    ("dnf", 28017),
+    ("gdm-session", 2035),
+]
+
+
+def synthetic_journal(
+    messages: int,
+    multiline_ratio: float,
+    match_density: float,
+    burstiness: float,
+    rate: float,
+    seed: int,
+):
+    """
+    Yield (timestamp, identifier, pid, message) tuples.
+
+    burstiness is the fraction of messages that arrive in a tight burst right
+    after their predecessor; the rest are spread out so that the mean rate
+    stays at about `rate` messages per second.
+    """
+    rng = random.Random(seed)
+    ts = datetime(2024, 1, 1, tzinfo=timezone(timedelta(hours=-7)))
+    burst_gap = 0.01 / rate
+    quiet_rate = rate * (1 - burstiness) if burstiness < 1 else rate
+    for _ in range(messages):
+        if rng.random() < burstiness:
+            gap = rng.expovariate(1 / burst_gap)
+        else:
+            gap = rng.expovariate(quiet_rate)
+        ts += timedelta(seconds=gap)
+        ident, pid = rng.choice(IDENTS)
+        words = rng.choices(WORDS, k=rng.randint(3, 16))
+        if rng.random() < match_density:
+            words.insert(rng.randrange(len(words) + 1), NEEDLE)
+        msg = " ".join(words)
+        if rng.random() < multiline_ratio:
+            msg += "".join(
+                "\n" + " ".join(rng.choices(WORDS, k=rng.randint(2, 10)))
+                for _ in range(rng.randint(1, 4))
+            )
+        yield ts, ident, pid, msg
+
+
+def render(records, output: str, hostname: str = "benchhost"):
+    """Format synthetic records the way journalctl -o <output> would."""
+    if output == "json":
+        for ts, ident, pid, msg in records:
+            usec = str(int(ts.timestamp() * 1e6))
+            entry = {
+                "__REALTIME_TIMESTAMP": usec,
+                "_HOSTNAME": hostname,
+                "SYSLOG_IDENTIFIER": ident,
+                "PRIORITY": "6",
+                "MESSAGE": msg,
+            }
+            if pid is not None:
+                entry["_PID"] = str(pid)
+            yield json.dumps(entry) + "\n"
+    elif output == "short-iso-precise":
+        for ts, ident, pid, msg in records:
+            tag = ident if pid is None else f"{ident}[{pid}]"
+            prefix = "{} {} {}: ".format(
+                ts.strftime("%Y-%m-%dT%H:%M:%S.%f%z"), hostname, tag
+            )
+            # continuation lines are indented to line up with the message
+            indent = "\n" + " " * len(prefix)
+            yield prefix + msg.replace("\n", indent) + "\n"
+    else:
+        raise ValueError(f"unsupported output format: {output}")
+
+
+def add_generator_args(ap: argparse.ArgumentParser):
+    ap.add_argument("-n", "--messages", type=int, default=200000)
+    ap.add_argument(
+        "--multiline-ratio",
+        type=float,
+        default=0.05,
+        help="fraction of messages with continuation lines",
+    )
+    ap.add_argument(
+        "--match-density",
+        type=float,
+        default=0.001,
+        help=f"fraction of messages containing {NEEDLE}",
+    )
+    ap.add_argument(
+        "--burstiness",
+        type=float,
+        default=0.5,
+        help="fraction of messages arriving in bursts, 0 to <1",
+    )
+    ap.add_argument(
+        "--rate", type=float, default=20, help="mean messages per second"
+    )
+    ap.add_argument("--seed", type=int, default=0)
+
+
+def generator_argv(args) -> List[str]:
+    return [
+        f"--messages={args.messages}",
+        f"--multiline-ratio={args.multiline_ratio}",
+        f"--match-density={args.match_density}",
+        f"--burstiness={args.burstiness}",
+        f"--rate={args.rate}",
+        f"--seed={args.seed}",
+    ]
+
+
+def fake_journalctl(argv: List[str]):
+    ap = argparse.ArgumentParser(prog="journalctl (fake)")
+    add_generator_args(ap)
+    ap.add_argument(
+        "--replay-dir",
+        help="stream pre-rendered <dir>/<output> instead of generating",
+    )
+    ap.add_argument("-o", "--output", default="short-iso-precise")
+    ap.add_argument("-q", "--quiet", action="store_true")
+    args, _ignored = ap.parse_known_args(argv)
+    if args.output not in FORMATS:
+        ap.error(f"unsupported output format: {args.output}")
+    if args.replay_dir is not None:
+        path = os.path.join(args.replay_dir, args.output)
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, sys.stdout.buffer, 2**20)
+        return
+    records = synthetic_journal(
+        args.messages,
+        args.multiline_ratio,
+        args.match_density,
+        args.burstiness,
+        args.rate,
+        args.seed,
+    )
+    out = io.TextIOWrapper(sys.stdout.buffer, write_through=False)
+    out.writelines(render(records, args.output))
+    out.flush()
+
+
+def install_fake(tmpdir: str, args) -> str:
+    """
+    Pre-render the journal into tmpdir and write a journalctl wrapper that
+    replays it, so the generator's cost doesn't show up in the measurements.
+    Returns the directory to prepend to PATH.
+    """
+    replay_dir = os.path.join(tmpdir, "replay")
+    bin_dir = os.path.join(tmpdir, "bin")
+    os.mkdir(replay_dir)
+    os.mkdir(bin_dir)
+    for output in FORMATS:
+        records = synthetic_journal(
+            args.messages,
+            args.multiline_ratio,
+            args.match_density,
+            args.burstiness,
+            args.rate,
+            args.seed,
+        )
+        with open(os.path.join(replay_dir, output), "w") as f:
+            f.writelines(render(records, output))
+    exe = os.path.join(bin_dir, "journalctl")
+    with open(exe, "w") as f:
+        f.write(
+            "#!/bin/sh\nexec {} {} fake --replay-dir={} \"$@\"\n".format(
+                shlex.quote(sys.executable),
+                shlex.quote(os.path.abspath(__file__)),
+                shlex.quote(replay_dir),
+            )
+        )
+    os.chmod(exe, 0o755)
+    return bin_dir
+
+
+STAGES = ["read", "parse", "match", "window", "print"]
+
+
+def run_untimed(journalctl: str, pattern: str, before: float, after: float):
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            journalctl_with_context(
+                pattern, before, after, [], False, journalctl
+            )
+
+
+def run_timed(
+    journalctl: str, pattern: str, before: float, after: float
+) -> Dict[str, float]:
+    """
+    One pass through journalctl_with_context() with its stage timers on.
+    Whatever isn't reading, parsing, matching or printing is the window.
+    """
+    times = dict.fromkeys(STAGES, 0.0)
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            journalctl_with_context(
+                pattern, before, after, [], False, journalctl, times
+            )
+            total = time.perf_counter() - start
+    times["window"] = total - sum(times.values())
+    return times
+
+
+def best_time(repeat: int, func: Callable, *args) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(func: Callable, *args) -> int:
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def parse_window(s: str) -> Tuple[float, float]:
+    """"B:A" gives -B B -A A, a lone number is -C"""
+    before, sep, after = s.partition(":")
+    return float(before), float(after if sep else before)
+
+
+def bench_json(journalctl: str, repeat: int) -> Tuple[float, float]:
+    """time to read and decode the same journal in -o json form"""
+
+    def read():
+        child = subprocess.Popen(
+            [journalctl, "-q", "-o", "json"], stdout=subprocess.PIPE
+        )
+        deque(child.stdout, maxlen=0)
+        child.wait()
+
+    def parse():
+        child = subprocess.Popen(
+            [journalctl, "-q", "-o", "json"], stdout=subprocess.PIPE
+        )
+        for line in child.stdout:
+            entry = json.loads(line)
+            datetime.fromtimestamp(
+                int(entry["__REALTIME_TIMESTAMP"]) / 1e6, timezone.utc
+            )
+        child.wait()
+
+    return best_time(repeat, read), best_time(repeat, parse)
+
+
+def run_benchmark(argv: List[str]):
+    ap = argparse.ArgumentParser(
+        prog=os.path.basename(__file__) + " run",
+        description="benchmark journalctl_with_context() on a fake journal",
+    )
+    add_generator_args(ap)
+    ap.add_argument(
+        "-w",
+        "--windows",
+        default="0,0:5,5:0,5,60",
+        help="comma-separated -B:-A pairs, a lone number means -C "
+        "(default: %(default)s)",
+    )
+    ap.add_argument("-p", "--pattern", default=NEEDLE)
+    ap.add_argument("-r", "--repeat", type=int, default=3)
+    ap.add_argument(
+        "--journalctl",
+        metavar="EXECUTABLE",
+        help="benchmark against this journalctl instead of the fake one",
+    )
+    ap.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip the (slow) tracemalloc pass",
+    )
+    args = ap.parse_args(argv)
+    windows = [parse_window(w) for w in args.windows.split(",")]
+    with tempfile.TemporaryDirectory(prefix="jcbench-") as tmpdir:
+        if args.journalctl is None:
+            bin_dir = install_fake(tmpdir, args)
+            os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+            journalctl = "journalctl"
+            print(f"# fake journalctl: {shlex.join(generator_argv(args))}")
+        else:
+            journalctl = args.journalctl
+        # count what journal_reader sees, since continuation lines don't count
+        nmsgs = sum(1 for _ in LogMessage.journal_reader([], journalctl))
+        print(f"# {nmsgs} messages, best of {args.repeat}, times in ms")
+        print(
+            "# {:>7} {:>7} {:>10} {:>8} ".format(
+                "before", "after", "msgs/s", "total"
+            )
+            + " ".join(f"{name:>8}" for name in STAGES)
+            + " {:>9}".format("peak_KiB")
+        )
+        for before, after in windows:
+            stage_args = (journalctl, args.pattern, before, after)
+            total = best_time(args.repeat, run_untimed, *stage_args)
+            # stage times from the timed pass with the smallest sum
+            stages = min(
+                (run_timed(*stage_args) for _ in range(args.repeat)),
+                key=lambda times: sum(times.values()),
+            )
+            if args.no_memory:
+                peak = float("nan")
+            else:
+                peak = peak_memory(run_untimed, *stage_args) / 2**10
+            print(
+                "  {:7g} {:7g} {:10.0f} {:8.1f} ".format(
+                    before, after, nmsgs / total, 1e3 * total
+                )
+                + " ".join(f"{1e3 * stages[name]:8.1f}" for name in STAGES)
+                + f" {peak:9.0f}"
+            )
+        json_read, json_parse = bench_json(journalctl, args.repeat)
+        print(
+            "# -o json: read {:.1f} ms, read+decode {:.1f} ms".format(
+                1e3 * json_read, 1e3 * json_parse
+            )
+        )
+
+
+if __name__ == "__main__":
+    commands = {"run": run_benchmark, "fake": fake_journalctl}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print(__doc__)
+        sys.exit(1)
+    try:
+        commands[sys.argv[1]](sys.argv[2:])
+    except BrokenPipeError:
+        sys.exit(1)
@@ -17,36 +17,508 @@
 # Program for watching the energy monitoring interface exposed by intel_rapl.
 # On my machine, CPU core, CPU package, and DRAM power are shown.
 
+import abc
+import errno
+import heapq
+import math
+import os
+import resource
+import signal
 import sys
 import time
 import argparse
 import contextlib
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple
 
+POWERCAP_ROOT = "/sys/class/powercap"
+PROCFS_ROOT = "/proc"
+CGROUP_ROOT = "/sys/fs/cgroup"
+# open files to leave free when keeping stat files open
+FD_HEADROOM = 64
 
-def powergen(rapl_sys_path):
-    syspath = Path(rapl_sys_path)
-    rollover_limit = int(syspath.joinpath("max_energy_range_uj").read_text())
-    with open(syspath.joinpath("energy_uj")) as f:
-        last_uj = int(f.read())
-        last_time = time.time()
-        yield 0.0  # can't give meaningful data until we've been run twice
-        while True:
-            f.seek(0)
-            cur_uj = int(f.read())
-            cur_time = time.time()
-            if cur_uj > last_uj:
-                delta_uj = cur_uj - last_uj
-            else:
-                delta_uj = cur_uj + rollover_limit - last_uj
-            power_w = 1e-6 * delta_uj / (cur_time - last_time)
-            last_time = cur_time
-            last_uj = cur_uj
-            yield power_w
 
+@dataclass
+class RaplDomain:
+    name: str
+    fd: int
+    rollover_limit: int
+
+
+class RaplSampler:
+    """
+    Reads the energy counters of several RAPL domains back-to-back.
+
+    The energy_uj files are kept open and re-read with pread, so a sample is
+    one syscall per domain, with a single monotonic timestamp taken right
+    after the last read. Time spent inside sample() is accumulated in
+    overhead_ns so callers can tell how much the sampling itself costs.
+    """
+
+    def __init__(self, rapls: List[Tuple[str, Path]]):
+        self.domains: List[RaplDomain] = []
+        self.overhead_ns = 0
+        self.samples = 0
+        try:
+            for name, syspath in rapls:
+                rollover_limit = int(
+                    syspath.joinpath("max_energy_range_uj").read_text()
+                )
+                fd = os.open(syspath.joinpath("energy_uj"), os.O_RDONLY)
+                self.domains.append(RaplDomain(name, fd, rollover_limit))
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def names(self) -> List[str]:
+        return [d.name for d in self.domains]
+
+    def sample(self) -> Tuple[int, List[int]]:
+        """returns (monotonic time in ns, [energy in uJ for each domain])"""
+        start_ns = time.monotonic_ns()
+        energies = [int(os.pread(d.fd, 32, 0)) for d in self.domains]
+        now_ns = time.monotonic_ns()
+        self.overhead_ns += now_ns - start_ns
+        self.samples += 1
+        return now_ns, energies
+
+    def power(
+        self, last: Tuple[int, List[int]], cur: Tuple[int, List[int]]
+    ) -> List[float]:
+        """average power in W of each domain between two samples"""
+        dt_ns = cur[0] - last[0]
+        return [
+            1e3 * ((cur_uj - last_uj) % d.rollover_limit) / dt_ns
+            for d, last_uj, cur_uj in zip(self.domains, last[1], cur[1])
+        ]
+
+    def close(self):
+        for d in self.domains:
+            os.close(d.fd)
+        self.domains.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PowerStats:
+    """
+    min, max, p95 and p99 of the power samples within one interval.
+
+    The number of samples per interval is known up front, so the percentiles
+    can be exact while only keeping the largest 5% or so of them, in a
+    min-heap.
+    """
+
+    fields = ["min", "max", "p95", "p99"]
+
+    def __init__(self, samples: int):
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.count = 0
+        # enough of the largest samples to interpolate the 95th percentile
+        self.keep = min(samples, math.ceil(0.05 * samples) + 1)
+        self.top: List[float] = []
+
+    def add(self, watts: float):
+        self.min = min(self.min, watts)
+        self.max = max(self.max, watts)
+        self.count += 1
+        if len(self.top) < self.keep:
+            heapq.heappush(self.top, watts)
+        elif watts > self.top[0]:
+            heapq.heapreplace(self.top, watts)
+
+    def percentile(self, p: float) -> float:
+        """linear interpolation between the closest ranks, like numpy's"""
+        if self.count == 0:
+            return float("nan")
+        if self.count > len(self.top) and p < 0.95:
+            raise ValueError("only the top 5% of samples are kept")
+        # descending[i] is the i-th largest sample
+        descending = sorted(self.top, reverse=True)
+        rank = p * (self.count - 1)
+        lo = int(rank)
+        hi = min(lo + 1, self.count - 1)
+        lo_val = descending[self.count - 1 - lo]
+        hi_val = descending[self.count - 1 - hi]
+        return lo_val + (rank - lo) * (hi_val - lo_val)
+
+    @property
+    def p95(self) -> float:
+        return self.percentile(0.95)
+
+    @property
+    def p99(self) -> float:
+        return self.percentile(0.99)
+
+
+class Recorder:
+    """
+    Writes samples in the commented-header whitespace format that ezplot.py
+    reads: a "# time name1 name2 ..." line, then one row per sample with the
+    unix time in seconds and the power of each domain in W.
+
+    Rows are collected and written out block_size bytes at a time, or after
+    flush_interval seconds if that comes first, so the file can be followed
+    while recording. If rotate_size is given, once a file reaches it (checked
+    after each write) the file is renamed to <path>.1, <path>.2, ... in
+    capture order (continuing after any left by an earlier capture) and a
+    fresh one is started, each with its own header.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        names: List[str],
+        block_size: int = 2**16,
+        rotate_size: Optional[int] = None,
+        flush_interval: float = 10,
+    ):
+        self.path = path
+        self.header = "# time " + " ".join(unique_names(names)) + "\n"
+        self.block_size = block_size
+        self.flush_interval_ns = round(flush_interval * 1e9)
+        self.next_flush_ns = time.monotonic_ns() + self.flush_interval_ns
+        self.rotate_size = None if path == "-" else rotate_size
+        # carry on after the rotated files of an earlier capture, rather
+        # than renaming over them
+        self.rotations = 0
+        if self.rotate_size is not None:
+            self.rotations = last_rotation(path)
+            if os.path.exists(path):
+                # the end of that earlier capture
+                self.rotations += 1
+                os.rename(path, "{}.{}".format(path, self.rotations))
+        self.buf: List[str] = []
+        self.buf_len = 0
+        self.file_len = 0
+        self.f: TextIO = self._open()
+
+    def _open(self) -> TextIO:
+        if self.path == "-":
+            f = sys.stdout
+        else:
+            f = open(self.path, "w")
+        f.write(self.header)
+        self.file_len = len(self.header)
+        return f
+
+    def write(self, unix_time: float, watts: List[float]):
+        row = "{:.6f} ".format(unix_time)
+        row += " ".join("{:.3f}".format(w) for w in watts) + "\n"
+        self.buf.append(row)
+        self.buf_len += len(row)
+        if (
+            self.buf_len >= self.block_size
+            or time.monotonic_ns() >= self.next_flush_ns
+        ):
+            self.flush()
+            if self.rotate_size is not None:
+                if self.file_len >= self.rotate_size:
+                    self.rotate()
+
+    def flush(self):
+        self.f.write("".join(self.buf))
+        self.f.flush()
+        self.file_len += self.buf_len
+        self.buf.clear()
+        self.buf_len = 0
+        self.next_flush_ns = time.monotonic_ns() + self.flush_interval_ns
+
+    def rotate(self):
+        self.f.close()
+        self.rotations += 1
+        os.rename(self.path, "{}.{}".format(self.path, self.rotations))
+        self.f = self._open()
+
+    def close(self):
+        self.flush()
+        if self.f is not sys.stdout:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def raise_fd_limit() -> int:
+    """
+    Raise the soft limit on open files as far as the hard limit allows, and
+    return the soft limit in effect.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # an unlimited hard limit still can't go past fs.nr_open
+    target = 2**20 if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class CpuTimeTracker(abc.ABC):
+    """
+    Follows the CPU time used by a changing set of processes or cgroups.
+
+    The stat file of every tracked entity stays open and is re-read with
+    pread, so after the first sighting an entity costs one syscall per
+    update. At most max_fds files are kept open (by default the open files
+    limit less FD_HEADROOM); entities past that are read with open, pread
+    and close each time instead. Entities that scan() stops returning, or
+    whose file can no longer be read (the process exited or the cgroup was
+    removed), are dropped, and newly found ones are only baselined, so their
+    CPU time before they were first seen isn't counted. Subclasses say where
+    to look and how to parse.
+    """
+
+    def __init__(self, root: str, max_fds: Optional[int] = None):
+        self.root = root
+        if max_fds is None:
+            soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            max_fds = soft - FD_HEADROOM
+        self.max_fds = max_fds
+        self.pinned = 0
+        self.warned = False
+        # key -> open fd, or None when it's read with open/pread/close
+        self.fds: Dict[str, Optional[int]] = {}
+        self.last: Dict[str, int] = {}
+        self.labels: Dict[str, str] = {}
+
+    @abc.abstractmethod
+    def scan(self) -> Iterable[str]:
+        """keys of the entities that currently exist"""
+
+    @abc.abstractmethod
+    def path(self, key: str) -> str:
+        """the stat file of an entity"""
+
+    @abc.abstractmethod
+    def parse(self, key: str, data: bytes) -> Tuple[int, str]:
+        """returns (cpu time, label) from the contents of the stat file"""
+
+    def _read(self, key: str) -> int:
+        fd = self.fds[key]
+        if fd is None:
+            fd = os.open(self.path(key), os.O_RDONLY)
+            try:
+                data = os.pread(fd, 4096, 0)
+            finally:
+                os.close(fd)
+        else:
+            data = os.pread(fd, 4096, 0)
+        cpu_time, self.labels[key] = self.parse(key, data)
+        return cpu_time
+
+    def _open(self, key: str):
+        """start tracking key, keeping its file open if there's room"""
+        if self.pinned < self.max_fds:
+            try:
+                self.fds[key] = os.open(self.path(key), os.O_RDONLY)
+                self.pinned += 1
+                return
+            except OSError as e:
+                if e.errno not in (errno.EMFILE, errno.ENFILE):
+                    raise
+                # something else is using up the limit, stop trying
+                self.max_fds = self.pinned
+        if not self.warned:
+            print(
+                "powermon: can't keep more than {} stat files open, reading "
+                "the rest with open/read/close".format(self.pinned),
+                file=sys.stderr,
+            )
+            self.warned = True
+        self.fds[key] = None
 
-def find_rapls():
-    for p in Path("/sys/class/powercap/").glob("*"):
+    def _drop(self, key: str):
+        fd = self.fds.pop(key)
+        if fd is not None:
+            os.close(fd)
+            self.pinned -= 1
+        self.last.pop(key, None)
+        self.labels.pop(key, None)
+
+    def deltas(self) -> Dict[str, int]:
+        """CPU time used by each entity since the last call"""
+        present = set(self.scan())
+        for key in self.fds.keys() - present:
+            self._drop(key)
+        deltas = {}
+        for key in list(self.fds):
+            try:
+                cur = self._read(key)
+            except (OSError, ValueError, IndexError):
+                self._drop(key)
+                continue
+            deltas[key] = cur - self.last[key]
+            self.last[key] = cur
+        for key in present - self.fds.keys():
+            try:
+                self._open(key)
+            except OSError:
+                continue  # gone already, or not ours to read
+            try:
+                self.last[key] = self._read(key)
+            except (OSError, ValueError, IndexError):
+                self._drop(key)
+        return deltas
+
+    def close(self):
+        for key in list(self.fds):
+            self._drop(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ProcessCpuTracker(CpuTimeTracker):
+    """utime + stime from /proc/<pid>/stat, in clock ticks"""
+
+    def scan(self) -> Iterable[str]:
+        return (name for name in os.listdir(self.root) if name.isdigit())
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key, "stat")
+
+    def parse(self, key: str, data: bytes) -> Tuple[int, str]:
+        # comm can contain spaces and parens, so split around the last ")"
+        head, _, tail = data.rpartition(b")")
+        fields = tail.split()
+        comm = head.partition(b"(")[2].decode(errors="replace")
+        # fields[0] is field 3 (state) in proc(5), utime and stime are 14, 15
+        return int(fields[11]) + int(fields[12]), "{} {}".format(key, comm)
+
+
+class CgroupCpuTracker(CpuTimeTracker):
+    """
+    usage_usec from cpu.stat of every leaf cgroup (cgroup v2). Only leaves
+    are tracked, because a parent's usage includes its children's.
+    """
+
+    def scan(self) -> Iterable[str]:
+        for dirpath, dirnames, filenames in os.walk(
+            self.root, onerror=self._walk_error
+        ):
+            if not dirnames and "cpu.stat" in filenames:
+                yield os.path.relpath(dirpath, self.root)
+
+    @staticmethod
+    def _walk_error(e: OSError):
+        # a cgroup removed mid-walk is fine, anything else (like running out
+        # of fds) would silently leave cgroups out
+        if not isinstance(e, FileNotFoundError):
+            raise e
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key, "cpu.stat")
+
+    def parse(self, key: str, data: bytes) -> Tuple[int, str]:
+        for line in data.splitlines():
+            name, _, value = line.partition(b" ")
+            if name == b"usage_usec":
+                return int(value), key
+        raise ValueError("no usage_usec in cpu.stat")
+
+
+def attribute_energy(
+    sampler: RaplSampler,
+    tracker: CpuTimeTracker,
+    domain_prefix: str,
+    interval_ns: int,
+    top: int,
+):
+    """
+    Every interval, split the energy of the RAPL domains whose names start
+    with domain_prefix between the tracked processes or cgroups, in
+    proportion to the CPU time each used, and print the top consumers.
+    """
+    domains = [
+        i
+        for i, name in enumerate(sampler.names)
+        if name.startswith(domain_prefix)
+    ]
+    if not domains:
+        raise SystemExit(f"no RAPL domain named {domain_prefix}*")
+    total_j: Dict[str, float] = {}
+    last = sampler.sample()
+    tracker.deltas()
+    next_sample_ns = last[0] + interval_ns
+    while True:
+        time.sleep(max(0, next_sample_ns - time.monotonic_ns()) / 1e9)
+        next_sample_ns += interval_ns
+        cur = sampler.sample()
+        cpu = tracker.deltas()
+        watts = sum(sampler.power(last, cur)[i] for i in domains)
+        joules = watts * (cur[0] - last[0]) / 1e9
+        last = cur
+        busy = sum(cpu.values())
+        # forget the totals of anything that's gone
+        for key in total_j.keys() - cpu.keys():
+            del total_j[key]
+        shares = {}
+        for key, ticks in cpu.items():
+            share = ticks / busy if busy else 0.0
+            shares[key] = share
+            total_j[key] = total_j.get(key, 0.0) + share * joules
+        lines = ["{}: {:.2f} W".format(domain_prefix, watts)]
+        lines.append("{:>8} {:>6} {:>10}  {}".format("W", "%", "J", "name"))
+        for key in sorted(shares, key=shares.get, reverse=True)[:top]:
+            if shares[key] == 0:
+                break
+            lines.append(
+                "{:8.2f} {:6.1f} {:10.1f}  {}".format(
+                    shares[key] * watts,
+                    100 * shares[key],
+                    total_j[key],
+                    tracker.labels[key],
+                )
+            )
+        print("\n".join(lines) + "\n")
+
+
+def last_rotation(path: str) -> int:
+    """highest N among existing <path>.N files, or 0"""
+    directory, name = os.path.split(os.path.abspath(path))
+    last = 0
+    for entry in os.listdir(directory):
+        prefix, _, suffix = entry.rpartition(".")
+        if prefix == name and suffix.isdigit():
+            last = max(last, int(suffix))
+    return last
+
+
+def unique_names(names: List[str]) -> List[str]:
+    """
+    Suffix repeated names (e.g. "core" on a two-socket machine) with .1, .2
+    etc. so they stay separate columns.
+    """
+    seen = {}
+    unique = []
+    for name in names:
+        if name in seen:
+            seen[name] += 1
+            unique.append("{}.{}".format(name, seen[name]))
+        else:
+            seen[name] = 0
+            unique.append(name)
+    return unique
+
+
+def find_rapls(root: str = POWERCAP_ROOT):
+    for p in sorted(Path(root).glob("*")):
         namepath = p.joinpath("name")
         if namepath.is_file():
             yield (namepath.read_text().strip(), p)
@@ -57,25 +529,184 @@ def main():
         description="Print power estimates for all RPAL energy domains"
     )
     parser.add_argument("-i", "--interval", type=float, default=1)
+    parser.add_argument(
+        "-s",
+        "--sample-interval",
+        metavar="SECONDS",
+        type=float,
+        help="oversample: read the counters every SECONDS and report the "
+        "mean, min, max, p95 and p99 power of each interval "
+        "(RAPL counters update about every 1 ms)",
+    )
+    parser.add_argument(
+        "--sysfs-root",
+        default=POWERCAP_ROOT,
+        help="powercap class directory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--overhead",
+        action="store_true",
+        help="show time spent sampling, per sample and as share of interval",
+    )
+    parser.add_argument(
+        "-r",
+        "--record",
+        metavar="FILE",
+        help="write a time series readable by ezplot.py to FILE "
+        "(- for stdout) instead of printing",
+    )
+    parser.add_argument(
+        "--rotate-size",
+        metavar="MiB",
+        type=float,
+        help="when recording, move FILE to FILE.1, FILE.2, ... "
+        "once it reaches this size",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        metavar="SECONDS",
+        type=float,
+        default=10,
+        help="when recording, write out buffered rows at least this often "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "-a",
+        "--attribute",
+        choices=["process", "cgroup"],
+        help="split CPU energy between processes or cgroups by CPU time "
+        "and show the top consumers",
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        default=10,
+        help="rows to show when attributing (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--domain",
+        default="package",
+        help="attribute the energy of the RAPL domains whose names start "
+        "with this (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--procfs-root",
+        default=PROCFS_ROOT,
+        help="procfs mount (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cgroup-root",
+        default=CGROUP_ROOT,
+        help="cgroup v2 mount (default: %(default)s)",
+    )
     args = parser.parse_args()
-    rapl_gens = [(name, powergen(path)) for name, path in find_rapls()]
-    # eat the inital zeros
-    for _, gen in rapl_gens:
-        next(gen)
-    # measure and print power readings every args.interval seconds, forever
-    next_sample_time = time.time() + args.interval
-    while True:
-        time.sleep(next_sample_time - time.time())
-        next_sample_time += args.interval
-        print(
-            "    ".join(
-                "{}: {:6.2f} W".format(name, next(pgen))
-                for name, pgen in rapl_gens
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    if args.sample_interval is not None and args.sample_interval <= 0:
+        parser.error("--sample-interval must be positive")
+    interval_ns = round(args.interval * 1e9)
+    if args.attribute is not None:
+        raise_fd_limit()
+        if args.attribute == "process":
+            tracker = ProcessCpuTracker(args.procfs_root)
+        else:
+            tracker = CgroupCpuTracker(args.cgroup_root)
+        rapls = list(find_rapls(args.sysfs_root))
+        with RaplSampler(rapls) as sampler, tracker:
+            attribute_energy(
+                sampler, tracker, args.domain, interval_ns, args.top
+            )
+        return
+    oversample = 1
+    if args.sample_interval is not None:
+        oversample = round(args.interval / args.sample_interval)
+        if oversample < 2:
+            parser.error(
+                "--sample-interval must give at least 2 samples per interval"
             )
+    sample_ns = interval_ns // oversample
+    with contextlib.ExitStack() as stack:
+        sampler = stack.enter_context(
+            RaplSampler(list(find_rapls(args.sysfs_root)))
         )
+        recorder = None
+        if args.record is not None:
+            rotate_size = None
+            if args.rotate_size is not None:
+                rotate_size = round(args.rotate_size * 2**20)
+            columns = sampler.names
+            if oversample > 1:
+                columns = [
+                    "{}.{}".format(name, field) if field else name
+                    for name in sampler.names
+                    for field in [None] + PowerStats.fields
+                ]
+            recorder = stack.enter_context(
+                Recorder(
+                    args.record,
+                    columns,
+                    rotate_size=rotate_size,
+                    flush_interval=args.flush_interval,
+                )
+            )
+        # offset for turning monotonic sample times into unix times
+        unix_offset_ns = time.time_ns() - time.monotonic_ns()
+        interval_start = last = sampler.sample()
+        # measure and print power readings every args.interval seconds, forever
+        next_sample_ns = last[0] + sample_ns
+        while True:
+            stats = [PowerStats(oversample) for _ in sampler.names]
+            for _ in range(oversample):
+                time.sleep(max(0, next_sample_ns - time.monotonic_ns()) / 1e9)
+                next_sample_ns += sample_ns
+                cur = sampler.sample()
+                if oversample > 1:
+                    for st, watts in zip(stats, sampler.power(last, cur)):
+                        st.add(watts)
+                last = cur
+            # the mean comes from the energy used over the whole interval
+            means = sampler.power(interval_start, cur)
+            interval_start = cur
+            if recorder is not None:
+                unix_time = (cur[0] + unix_offset_ns) / 1e9
+                if oversample > 1:
+                    row = []
+                    for mean, st in zip(means, stats):
+                        row.append(mean)
+                        row.extend(getattr(st, f) for f in PowerStats.fields)
+                    recorder.write(unix_time, row)
+                else:
+                    recorder.write(unix_time, means)
+                continue
+            if oversample > 1:
+                line = "  ".join(
+                    "{}: {:6.2f} W "
+                    "[min {:.1f} p95 {:.1f} p99 {:.1f} max {:.1f}]"
+                    .format(name, mean, st.min, st.p95, st.p99, st.max)
+                    for name, mean, st in zip(sampler.names, means, stats)
+                )
+            else:
+                line = "    ".join(
+                    "{}: {:6.2f} W".format(name, watts)
+                    for name, watts in zip(sampler.names, means)
+                )
+            if args.overhead:
+                per_sample_ns = sampler.overhead_ns / sampler.samples
+                line += "    overhead: {:.1f} us ({:.3f}%)".format(
+                    per_sample_ns / 1e3, 100 * per_sample_ns / sample_ns
+                )
+            print(line)
+
+
+def exit_on_signal(signum, frame):
+    # unwind normally, so a recording gets flushed and closed
+    sys.exit(128 + signum)
 
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    signal.signal(signal.SIGHUP, exit_on_signal)
     try:
         main()
     except KeyboardInterrupt:
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark trim-common-prefixes.py against cat and the original
+line-at-a-time implementation, on a synthetic journal dump.
+
+Usage:
+    trim-common-prefixes-bench.py [options]
+"""
+
+from typing import List
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from journalctl_context_bench import synthetic_journal, render
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TRIM = os.path.join(HERE, "trim-common-prefixes.py")
+
+
+def legacy():
+    """the original implementation, for comparison"""
+    oldline = []
+    for line in sys.stdin:
+        prefix = []
+        for wordx, word in enumerate(line.split()):
+            if wordx >= len(oldline):
+                break
+            if word != oldline[wordx]:
+                break
+            prefix.append("-" * len(word))
+        print(" ".join(prefix + line.split()[wordx:]))
+        oldline = line.split()
+
+
+def best_time(repeat: int, cmd: List[str], infile: str, outfile: str):
+    best = float("inf")
+    for _ in range(repeat):
+        with open(infile, "rb") as fin, open(outfile, "wb") as fout:
+            start = time.perf_counter()
+            subprocess.run(cmd, stdin=fin, stdout=fout, check=True)
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("-n", "--messages", type=int, default=500000)
+    ap.add_argument("-r", "--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument(
+        "-w",
+        "--window",
+        type=int,
+        default=64,
+        help="window size for the --window run (default: %(default)s)",
+    )
+    ap.add_argument(
+        "--input", help="benchmark on this file instead of a synthetic one"
+    )
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory(prefix="trimbench-") as tmpdir:
+        infile = args.input
+        if infile is None:
+            infile = os.path.join(tmpdir, "input")
+            records = synthetic_journal(
+                args.messages, 0.05, 0.0, 0.5, 20, args.seed
+            )
+            with open(infile, "w") as f:
+                f.writelines(render(records, "short-iso-precise"))
+        size = os.path.getsize(infile)
+        with open(infile, "rb") as f:
+            nlines = sum(1 for _ in f)
+        commands = {
+            "cat": ["cat"],
+            "legacy": [sys.executable, os.path.abspath(__file__), "legacy"],
+            "current": [sys.executable, TRIM],
+            "window": [sys.executable, TRIM, "--window", str(args.window)],
+        }
+        print(
+            "# {} lines, {:.1f} MiB, best of {}".format(
+                nlines, size / 2**20, args.repeat
+            )
+        )
+        print(
+            "# {:>8} {:>9} {:>10} {:>12}".format(
+                "impl", "s", "MiB/s", "lines/s"
+            )
+        )
+        outputs = {}
+        for name, cmd in commands.items():
+            outputs[name] = os.path.join(tmpdir, name)
+            secs = best_time(args.repeat, cmd, infile, outputs[name])
+            print(
+                "  {:>8} {:9.3f} {:10.1f} {:12.0f}".format(
+                    name, secs, size / 2**20 / secs, nlines / secs
+                )
+            )
+        with open(outputs["legacy"], "rb") as a:
+            with open(outputs["current"], "rb") as b:
+                if a.read() != b.read():
+                    print("# WARNING: current output differs from legacy")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["legacy"]:
+        legacy()
+    else:
+        main()
@@ -37,26 +37,257 @@ Usage:
     --- -- -------- -------- ----------- Metadata cache refreshed recently.
     --- -- -------- -------- systemd[1]: Started dnf makecache.
     --- -- 18:10:10 hogwarts /etc/gdm/Xsession[20359]: => suspend now!
+
+With --window N, each line is compared with the last N lines instead of only
+the previous one, and the longest common prefix among them is trimmed. That
+keeps interleaved output, like two services taking turns in the journal,
+short.
 """
 
+from collections import OrderedDict
+import argparse
 import sys
 
-if len(sys.argv) > 1:
-    print(__doc__)
-    exit(1)
+# read and write this much at a time
+BUFSIZE = 2**20
+DASHES = [b"-" * n for n in range(128)]
+# ASCII that str.split() treats as whitespace but bytes.split() doesn't
+SEPARATORS = bytes.maketrans(b"\x1c\x1d\x1e\x1f", b"    ")
+
+
+def dashes(word: bytes) -> bytes:
+    # count characters rather than bytes, so UTF-8 words get the same
+    # number of dashes they'd have as text
+    if word.isascii():
+        n = len(word)
+    else:
+        n = len(word.decode(errors="surrogateescape"))
+    return DASHES[n] if n < len(DASHES) else b"-" * n
+
+
+def split_words(line: bytes) -> list:
+    if line.isascii():
+        return line.translate(SEPARATORS).split()
+    # decode so that non-ASCII whitespace, like no-break spaces, separates
+    # words too
+    return [
+        word.encode(errors="surrogateescape")
+        for word in line.decode(errors="surrogateescape").split()
+    ]
+
+
+def word_batches(infile, bufsize: int = BUFSIZE):
+    """
+    Read infile bufsize bytes at a time, yielding a list of the words of each
+    complete line. Words are split the way str.split() splits text, so any
+    unicode whitespace separates them. Like text-mode sys.stdin, only \n
+    ends a line and a lone \r is just whitespace.
+    """
+    rest = b""
+    while True:
+        chunk = infile.read(bufsize)
+        if not chunk:
+            if rest:
+                yield [split_words(rest)]  # last line, without a newline
+            return
+        data = rest + chunk
+        lines = data.split(b"\n")
+        rest = lines.pop()
+        if data.isascii():
+            yield [line.translate(SEPARATORS).split() for line in lines]
+        else:
+            yield [split_words(line) for line in lines]
+
+
+def trim_common_prefixes(infile, outfile, bufsize: int = BUFSIZE):
+    """
+    Works on bytes, splits each line once and only remembers the previous
+    line's words. Input is read and output written bufsize bytes at a time.
+    """
+    oldwords = []
+    out = []
+    append = out.append
+    join = b" ".join
+    for batch in word_batches(infile, bufsize):
+        for words in batch:
+            if not words or not oldwords or words[0] != oldwords[0]:
+                # nothing in common, which is most lines with timestamps
+                append(join(words))
+                oldwords = words
+                continue
+            n = min(len(words), len(oldwords))
+            common = 1
+            while common < n and words[common] == oldwords[common]:
+                common += 1
+            if common == len(words):
+                # a line that matches entirely still ends with its last word
+                rest = words[-1:]
+            else:
+                rest = words[common:]
+            append(join([dashes(w) for w in words[:common]] + rest))
+            oldwords = words
+        append(b"")
+        outfile.write(b"\n".join(out))
+        out.clear()
+    outfile.flush()
+
+
+class TrieNode:
+    __slots__ = ("children", "lines", "tail")
+
+    def __init__(self, line_id, tail=None):
+        self.children = {}
+        # ids of the lines in the window that pass through this node, in the
+        # order they were added
+        self.lines = {line_id: None}
+        # (line id, words, index) when the rest of one line's words haven't
+        # been given nodes yet, see PrefixWindow
+        self.tail = tail
+
+
+class PrefixWindow:
+    """
+    Word-level trie of the last `size` lines, so finding the longest common
+    prefix with any of them, adding a line and evicting one each cost
+    O(words in the line), however big the window is.
+
+    Nodes are only made for words that some other line got to: once a line
+    branches off on its own, the rest of it is kept as the new node's tail
+    and expanded a word at a time if a later line follows it. With
+    timestamped input most lines branch off within a word or two.
+
+    evict="fifo" drops the oldest line. evict="lru" drops the line that was
+    least recently added or matched, so a line that keeps providing prefixes
+    stays in the window even when lots of other output goes past.
+    """
+
+    def __init__(self, size: int, evict: str = "fifo"):
+        self.size = size
+        self.lru = evict == "lru"
+        self.root = TrieNode(None)
+        self.window = OrderedDict()  # line id -> words
+        self.next_id = 0
+
+    def add(self, words) -> int:
+        """
+        Add a line to the window, returning the number of leading words it
+        shares with some line that was already there.
+        """
+        line_id = self.next_id
+        self.next_id += 1
+        node = self.root
+        depth = 0
+        newest = None
+        for word in words:
+            child = node.children.get(word)
+            if child is None:
+                tail = node.tail
+                if tail is None or tail[1][tail[2]] != word:
+                    break
+                # follow the other line: give its next word a node
+                other_id, other_words, i = tail
+                i += 1
+                if i == len(other_words):
+                    tail = None
+                else:
+                    tail = (other_id, other_words, i)
+                child = TrieNode(other_id, tail)
+                node.children[word] = child
+                node.tail = None
+            newest = next(reversed(child.lines))
+            child.lines[line_id] = None
+            node = child
+            depth += 1
+        else:
+            word = None
+        if word is not None:
+            # branch off
+            tail = None
+            if depth + 1 < len(words):
+                tail = (line_id, words, depth + 1)
+            node.children[word] = TrieNode(line_id, tail)
+        if self.lru and newest is not None:
+            # refresh the newest line that shares the whole prefix
+            self.window.move_to_end(newest)
+        self.window[line_id] = words
+        if len(self.window) > self.size:
+            self.evict(*self.window.popitem(last=False))
+        return depth
 
-oldline = []
+    def evict(self, line_id, words):
+        node = self.root
+        for word in words:
+            child = node.children.get(word)
+            if child is None:
+                break
+            del child.lines[line_id]
+            if not child.lines:
+                # nothing else below here either
+                del node.children[word]
+                return
+            node = child
+        if node.tail is not None and node.tail[0] == line_id:
+            node.tail = None
 
-for line in sys.stdin:
-    prefix = []
-    for wordx, word in enumerate(line.split()):
-        if wordx >= len(oldline):
-            break
-        if word != oldline[wordx]:
-            break
-        prefix.append("-"*len(word))
-    print(" ".join(prefix + line.split()[wordx:]))
-    oldline = line.split()
 
+def trim_common_prefixes_window(
+    infile,
+    outfile,
+    size: int,
+    evict: str = "fifo",
+    bufsize: int = BUFSIZE,
+):
+    """like trim_common_prefixes(), but against a PrefixWindow"""
+    window = PrefixWindow(size, evict)
+    out = []
+    append = out.append
+    join = b" ".join
+    for batch in word_batches(infile, bufsize):
+        for words in batch:
+            common = window.add(words)
+            if common == 0:
+                append(join(words))
+            else:
+                if common == len(words):
+                    # a line that matches entirely still ends with its last
+                    # word
+                    rest = words[-1:]
+                else:
+                    rest = words[common:]
+                append(join([dashes(w) for w in words[:common]] + rest))
+        append(b"")
+        outfile.write(b"\n".join(out))
+        out.clear()
+    outfile.flush()
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        metavar="N",
+        type=int,
+        default=1,
+        help="compare each line with the last N lines (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-e",
+        "--evict",
+        choices=["fifo", "lru"],
+        default="fifo",
+        help="which line leaves a full window: the oldest, or the least "
+        "recently added or matched (default: %(default)s)",
+    )
+    args = parser.parse_args()
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+    if args.window == 1:
+        trim_common_prefixes(sys.stdin.buffer, sys.stdout.buffer)
+    else:
+        trim_common_prefixes_window(
+            sys.stdin.buffer, sys.stdout.buffer, args.window, args.evict
+        )